@@ -5,29 +5,106 @@ import sqlite3
 import threading
 import time
 import uuid
-import json
 import re
-from datetime import datetime
+import orjson
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from llama_cpp import Llama
+from llama_cpp.llama_cache import LlamaRAMCache
 
 from config import LLAMA3_MODEL
 
+# Memory extraction patterns, compiled once and matched case-insensitively
+# (more specific "i am ..." forms come first and claim their match position)
+_FACT_PATTERNS = [
+    (re.compile(r"my name is (\w+)", re.I), "name"),
+    (re.compile(r"i am (\d+) years old", re.I), "age"),
+    (re.compile(r"i am a ([^,.]+)", re.I), "profession"),
+    (re.compile(r"i am (\w+)", re.I), "name"),
+    (re.compile(r"call me (\w+)", re.I), "name"),
+    (re.compile(r"i live in ([^,.]+)", re.I), "location"),
+    (re.compile(r"i work as a ([^,.]+)", re.I), "job"),
+    (re.compile(r"my job is ([^,.]+)", re.I), "job"),
+]
+
+_PREF_PATTERNS = [
+    (re.compile(r"i like ([^,.]+)", re.I), "likes"),
+    (re.compile(r"i love ([^,.]+)", re.I), "loves"),
+    (re.compile(r"i prefer ([^,.]+)", re.I), "prefers"),
+    (re.compile(r"my favorite ([^\s]+) is ([^,.]+)", re.I), "favorites"),
+    (re.compile(r"i don't like ([^,.]+)", re.I), "dislikes"),
+    (re.compile(r"i hate ([^,.]+)", re.I), "hates"),
+]
+
+_EXP_PATTERNS = [
+    re.compile(r"i (went to|visited|traveled to) ([^,.]+)", re.I),
+    re.compile(r"i (learned|studied) ([^,.]+)", re.I),
+    re.compile(r"i (bought|purchased) ([^,.]+)", re.I),
+    re.compile(r"i (finished|completed) ([^,.]+)", re.I),
+    re.compile(r"i (started) ([^,.]+)", re.I),
+]
+
+# Llama 3 chat template pieces, pre-encoded for prompt assembly
+_U_PRE = b"<|start_header_id|>user<|end_header_id|>\n\n"
+_U_POST = b"<|eot_id|>"
+_A_PRE = b"<|start_header_id|>assistant<|end_header_id|>\n\n"
+_A_POST = b"<|eot_id|>"
+_A_TRAIL = _A_PRE
+
+_TOPICS = ("programming", "python", "javascript", "machine learning", "ai", "artificial intelligence", "data science", "web development", "coding", "software")
+_TOPIC_RE = re.compile(r'\b(' + "|".join(_TOPICS) + r')\b', re.I)
+
+_TOPIC_SET = frozenset(_TOPICS)
+_WORD_RE = re.compile(r"\w+")
+_SELF_QUERY_RE = re.compile(r"my name|who am i|about me|remember me|know about me", re.I)
+
+_QUOTE_STRIP = re.compile(r'^["\']|["\']$')
+
+
+class ModelBusyError(RuntimeError):
+    """Raised when the model request queue is full"""
+
 
 class Llama3MultiChatServer:
     def __init__(self):
         self.model = None
         self.chat_sessions = {}
+        self._turn_counters = {}
+        self._prompt_prefixes = {}
         self.max_context_pairs = 10
+        self.sink_pairs = 2
         self.max_context_tokens = 6000
+        self._tokenize = None
 
         # Make database path relative to this script
         script_dir = Path(__file__).parent
         data_dir = script_dir / "../data"
         data_dir.mkdir(exist_ok=True)
         self.memory_db = data_dir / "llama3_multichat_memory.db"
-        self.model_busy = False
-        self.model_lock = threading.Lock()
+        self.max_pending_requests = 4
+        self.stream_batch_tokens = 8
+        self.stream_batch_interval = 0.02
+
+        # llama.cpp is not re-entrant: all model calls run on one worker
+        # thread, with a bounded number of requests allowed to wait for it
+        self._model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama")
+        self._pending_slots = threading.BoundedSemaphore(self.max_pending_requests)
+
+        # Single long-lived connection shared by the request threads;
+        # transactions are managed explicitly via _transaction()
+        self._db_lock = threading.RLock()
+        self._conn = sqlite3.connect(self.memory_db, check_same_thread=False, isolation_level=None)
+        self._conn.executescript('''
+            PRAGMA auto_vacuum = INCREMENTAL;
+            PRAGMA foreign_keys = ON;
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA mmap_size = 268435456;
+            PRAGMA cache_size = -65536;
+        ''')
 
         self.init_database()
         self.load_model()
@@ -47,116 +124,170 @@ class Llama3MultiChatServer:
             model_path=model_path,
             n_ctx=LLAMA3_MODEL["n_ctx"],
             n_gpu_layers=LLAMA3_MODEL["n_gpu_layers"],
+            n_batch=LLAMA3_MODEL["n_batch"],
+            n_threads=LLAMA3_MODEL["n_threads"],
+            n_threads_batch=LLAMA3_MODEL["n_threads_batch"],
+            logits_all=LLAMA3_MODEL["logits_all"],
+            use_mmap=LLAMA3_MODEL["use_mmap"],
+            use_mlock=LLAMA3_MODEL["use_mlock"],
             verbose=False,
             seed=-1
         )
 
+        # Completions reuse the longest token prefix already evaluated in the
+        # context; the state cache extends that across chats, so switching back
+        # to a chat restores its KV state instead of re-prefilling the history
+        if LLAMA3_MODEL["kv_cache_bytes"]:
+            self.model.set_cache(LlamaRAMCache(capacity_bytes=LLAMA3_MODEL["kv_cache_bytes"]))
+
+        self._tokenize = self.model.tokenize
+
         load_time = time.time() - start_time
         print(f"✅ Model loaded in {load_time:.1f}s")
 
+    @contextmanager
+    def _transaction(self):
+        """Run the enclosed writes in a single transaction, joining an outer one if open"""
+        with self._db_lock:
+            if self._conn.in_transaction:
+                yield self._conn.cursor()
+                return
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn.cursor()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
     def init_database(self):
         """Initialize SQLite database for multi-chat support"""
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
-
-            # Create chats table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chats (
-                    id TEXT PRIMARY KEY,
-                    title TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # Create messages table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    tokens INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE
-                )
-            ''')
-
-            # Create facts table (per chat)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS facts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id TEXT NOT NULL,
-                    key TEXT NOT NULL,
-                    value TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE,
-                    UNIQUE(chat_id, key)
-                )
-            ''')
-
-            # Create preferences table (per chat)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS preferences (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id TEXT NOT NULL,
-                    category TEXT,
-                    item TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE
-                )
-            ''')
-
-            # Create experiences table (per chat)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS experiences (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id TEXT NOT NULL,
-                    experience TEXT,
-                    context TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE
-                )
-            ''')
-
-            # Create topics table (per chat)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS topics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id TEXT NOT NULL,
-                    topic TEXT NOT NULL,
-                    frequency INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE,
-                    UNIQUE(chat_id, topic)
-                )
-            ''')
-
-            conn.commit()
-            conn.close()
+            with self._transaction() as cursor:
+                # Create chats table
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS chats (
+                        id TEXT PRIMARY KEY,
+                        title TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+
+                # Create messages table
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS messages (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id TEXT NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        tokens INTEGER DEFAULT 0,
+                        turn_index INTEGER,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE
+                    )
+                ''')
+
+                # Older databases: add turn_index and number existing turns,
+                # giving each reply the index of the user message before it
+                cursor.execute("PRAGMA table_info(messages)")
+                if "turn_index" not in {column[1] for column in cursor.fetchall()}:
+                    cursor.execute("ALTER TABLE messages ADD COLUMN turn_index INTEGER")
+                    cursor.execute('''
+                        UPDATE messages SET turn_index = numbered.turn_index
+                        FROM (
+                            SELECT id, SUM(role = 'user') OVER (
+                                PARTITION BY chat_id ORDER BY id
+                            ) - 1 AS turn_index
+                            FROM messages
+                        ) AS numbered
+                        WHERE messages.id = numbered.id
+                    ''')
+
+                # Create facts table (per chat)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS facts (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        value TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE,
+                        UNIQUE(chat_id, key)
+                    )
+                ''')
+
+                # Create preferences table (per chat)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS preferences (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id TEXT NOT NULL,
+                        category TEXT,
+                        item TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE
+                    )
+                ''')
+
+                # Create experiences table (per chat)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS experiences (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id TEXT NOT NULL,
+                        experience TEXT,
+                        context TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE
+                    )
+                ''')
+
+                # Create topics table (per chat)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS topics (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id TEXT NOT NULL,
+                        topic TEXT NOT NULL,
+                        frequency INTEGER DEFAULT 1,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE,
+                        UNIQUE(chat_id, topic)
+                    )
+                ''')
+
+                # Indexes for the per-chat lookups (facts and topics are
+                # already covered by their UNIQUE(chat_id, ...) constraints)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_turn ON messages (chat_id, turn_index)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_prefs_chat_cat ON preferences (chat_id, category)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_experiences_chat_created ON experiences (chat_id, created_at DESC)")
+
+            # One-time migration for databases created before foreign keys and
+            # incremental auto_vacuum: purge rows orphaned while foreign keys were
+            # not enforced, then VACUUM so the auto_vacuum mode takes effect
+            with self._db_lock:
+                if self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    with self._transaction() as cursor:
+                        for table in ("messages", "facts", "preferences", "experiences", "topics"):
+                            cursor.execute(f"DELETE FROM {table} WHERE chat_id NOT IN (SELECT id FROM chats)")
+                    self._conn.execute("VACUUM")
+
             print("✅ Multi-chat database initialized")
 
         except Exception as e:
             print(f"⚠️ Database init error: {e}")
 
     def create_chat(self, first_message):
-        """Create a new chat and generate title"""
+        """Create a new chat with a placeholder title taken from the first message"""
         chat_id = str(uuid.uuid4())
-        title = self.generate_chat_title(first_message)
+        title = self.fallback_title(first_message)
 
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                INSERT INTO chats (id, title) VALUES (?, ?)
-            ''', (chat_id, title))
-
-            conn.commit()
-            conn.close()
+            with self._transaction() as cursor:
+                cursor.execute('''
+                    INSERT INTO chats (id, title) VALUES (?, ?)
+                ''', (chat_id, title))
 
             # Initialize empty conversation history
             self.chat_sessions[chat_id] = []
@@ -179,34 +310,46 @@ class Llama3MultiChatServer:
             )
 
             title = result['choices'][0]['text'].strip()
-            title = re.sub(r'^["\']|["\']$', '', title)
+            title = _QUOTE_STRIP.sub('', title)
             title = title.replace('\n', ' ').strip()
 
             if not title or len(title) > 50:
-                words = first_message.split()[:3]
-                title = ' '.join(words).capitalize()
+                return self.fallback_title(first_message)
 
-            return title if title else "New Chat"
+            return title
 
         except Exception as e:
             print(f"⚠️ Title generation error: {e}")
-            words = first_message.split()[:3]
-            return ' '.join(words).capitalize() if words else "New Chat"
+            return self.fallback_title(first_message)
+
+    def fallback_title(self, first_message):
+        """Cheap title from the first few words of the message"""
+        words = first_message.split()[:3]
+        return ' '.join(words).capitalize() if words else "New Chat"
+
+    def update_chat_title(self, chat_id, first_message):
+        """Replace a chat's placeholder title with a model-generated one"""
+        title = self.generate_chat_title(first_message)
+
+        try:
+            with self._transaction() as cursor:
+                cursor.execute("UPDATE chats SET title = ? WHERE id = ?", (title, chat_id))
+        except Exception as e:
+            print(f"⚠️ Error updating chat title: {e}")
 
     def get_chats(self):
         """Get list of all chats"""
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
+            with self._db_lock:
+                cursor = self._conn.cursor()
 
-            cursor.execute('''
-                SELECT id, title, created_at, updated_at
-                FROM chats
-                ORDER BY updated_at DESC
-            ''')
+                cursor.execute('''
+                    SELECT id, title, created_at, updated_at
+                    FROM chats
+                    ORDER BY updated_at DESC
+                ''')
 
-            chats = cursor.fetchall()
-            conn.close()
+                chats = cursor.fetchall()
 
             return [
                 {
@@ -225,18 +368,17 @@ class Llama3MultiChatServer:
     def get_chat_messages(self, chat_id):
         """Get messages for a specific chat"""
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
+            with self._db_lock:
+                cursor = self._conn.cursor()
 
-            cursor.execute('''
-                SELECT role, content, created_at
-                FROM messages
-                WHERE chat_id = ?
-                ORDER BY created_at ASC
-            ''', (chat_id,))
+                cursor.execute('''
+                    SELECT role, content, created_at
+                    FROM messages
+                    WHERE chat_id = ?
+                    ORDER BY turn_index ASC, role DESC
+                ''', (chat_id,))
 
-            messages = cursor.fetchall()
-            conn.close()
+                messages = cursor.fetchall()
 
             return [
                 {
@@ -251,83 +393,97 @@ class Llama3MultiChatServer:
             print(f"⚠️ Error getting messages: {e}")
             return []
 
+    def chat_exists(self, chat_id):
+        """Check whether a chat is still in the database"""
+        with self._db_lock:
+            return self._conn.execute("SELECT 1 FROM chats WHERE id = ?", (chat_id,)).fetchone() is not None
+
     def save_message(self, chat_id, role, content, tokens=0):
         """Save a message to the database"""
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                INSERT INTO messages (chat_id, role, content, tokens)
-                VALUES (?, ?, ?, ?)
-            ''', (chat_id, role, content, tokens))
-
-            cursor.execute('''
-                UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?
-            ''', (chat_id,))
+            with self._transaction() as cursor:
+                turn_index = self.next_turn_index(cursor, chat_id, role)
+                cursor.execute('''
+                    INSERT INTO messages (chat_id, role, content, tokens, turn_index)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (chat_id, role, content, tokens, turn_index))
 
-            conn.commit()
-            conn.close()
+                cursor.execute('''
+                    UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?
+                ''', (chat_id,))
 
         except Exception as e:
             print(f"⚠️ Error saving message: {e}")
 
-    def get_memory_counts(self, chat_id):
-        """Get memory counts for a specific chat"""
-        try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
+    def next_turn_index(self, cursor, chat_id, role):
+        """Get the turn index for a new message: user messages open a turn, replies join it"""
+        turn_index = self._turn_counters.get(chat_id)
+        if turn_index is None:
+            cursor.execute("SELECT MAX(turn_index) FROM messages WHERE chat_id = ?", (chat_id,))
+            turn_index = cursor.fetchone()[0]
+            if turn_index is None:
+                turn_index = -1
 
-            cursor.execute("SELECT COUNT(*) FROM facts WHERE chat_id = ?", (chat_id,))
-            facts_count = cursor.fetchone()[0]
+        if role == 'user':
+            turn_index += 1
 
-            cursor.execute("SELECT COUNT(*) FROM experiences WHERE chat_id = ?", (chat_id,))
-            experiences_count = cursor.fetchone()[0]
+        self._turn_counters[chat_id] = turn_index
+        return max(turn_index, 0)
 
-            cursor.execute("SELECT COUNT(*) FROM topics WHERE chat_id = ?", (chat_id,))
-            topics_count = cursor.fetchone()[0]
+    def get_memory_stats_payload(self, chat_id):
+        """Get memory counts for a specific chat, shaped for the API response"""
+        try:
+            with self._db_lock:
+                cursor = self._conn.cursor()
 
-            conn.close()
-            return facts_count, experiences_count, topics_count
+                cursor.execute('''
+                    SELECT
+                        (SELECT COUNT(*) FROM facts WHERE chat_id = ?1),
+                        (SELECT COUNT(*) FROM experiences WHERE chat_id = ?1),
+                        (SELECT COUNT(*) FROM topics WHERE chat_id = ?1)
+                ''', (chat_id,))
+                facts_count, experiences_count, topics_count = cursor.fetchone()
+
+            return {'facts': facts_count, 'experiences': experiences_count, 'topics': topics_count}
         except:
-            return 0, 0, 0
+            return {'facts': 0, 'experiences': 0, 'topics': 0}
 
     def get_relevant_memories(self, chat_id, user_input):
         """Retrieve relevant memories for current context"""
         relevant = []
-        user_lower = user_input.lower()
 
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
-
-            self_queries = ["my name", "who am i", "about me", "remember me", "know about me"]
-            if any(query in user_lower for query in self_queries):
-                cursor.execute("SELECT key, value FROM facts WHERE chat_id = ?", (chat_id,))
-                facts = cursor.fetchall()
-                if facts:
-                    facts_str = ", ".join([f"{k}: {v}" for k, v in facts])
-                    relevant.append(f"Facts about you: {facts_str}")
-
-                cursor.execute("SELECT category, GROUP_CONCAT(item, ', ') FROM preferences WHERE chat_id = ? GROUP BY category", (chat_id,))
-                prefs = cursor.fetchall()
-                if prefs:
-                    for category, items in prefs:
-                        relevant.append(f"You {category}: {items}")
-
-            cursor.execute("SELECT topic, frequency FROM topics WHERE chat_id = ? AND topic LIKE ?", (chat_id, f'%{user_lower}%'))
-            topics = cursor.fetchall()
-            for topic, count in topics:
-                if topic in user_lower:
-                    relevant.append(f"Previous {topic} discussions: {count} times")
-
-            cursor.execute("SELECT experience FROM experiences WHERE chat_id = ? ORDER BY created_at DESC LIMIT 5", (chat_id,))
-            experiences = cursor.fetchall()
-            for (experience,) in experiences:
-                if any(word in user_lower for word in experience.split()):
-                    relevant.append(f"Recent experience: {experience}")
-
-            conn.close()
+            with self._db_lock:
+                cursor = self._conn.cursor()
+
+                if _SELF_QUERY_RE.search(user_input):
+                    cursor.execute("SELECT key, value FROM facts WHERE chat_id = ?", (chat_id,))
+                    facts = cursor.fetchall()
+                    if facts:
+                        facts_str = ", ".join([f"{k}: {v}" for k, v in facts])
+                        relevant.append(f"Facts about you: {facts_str}")
+
+                    cursor.execute("SELECT category, GROUP_CONCAT(item, ', ') FROM preferences WHERE chat_id = ? GROUP BY category", (chat_id,))
+                    prefs = cursor.fetchall()
+                    if prefs:
+                        for category, items in prefs:
+                            relevant.append(f"You {category}: {items}")
+
+                # Tokenize once; topic and experience checks are set intersections
+                words = _WORD_RE.findall(user_input.lower())
+                user_words = set(words)
+                mentioned = _TOPIC_SET & (user_words | {" ".join(pair) for pair in zip(words, words[1:])})
+                if mentioned:
+                    placeholders = ", ".join("?" * len(mentioned))
+                    cursor.execute(f"SELECT topic, frequency FROM topics WHERE chat_id = ? AND topic IN ({placeholders})", (chat_id, *mentioned))
+                    topics = cursor.fetchall()
+                    for topic, count in topics:
+                        relevant.append(f"Previous {topic} discussions: {count} times")
+
+                cursor.execute("SELECT experience FROM experiences WHERE chat_id = ? ORDER BY created_at DESC LIMIT 5", (chat_id,))
+                for (experience,) in cursor.fetchall():
+                    if not user_words.isdisjoint(experience.split()):
+                        relevant.append(f"Recent experience: {experience}")
         except Exception as e:
             print(f"⚠️ Memory retrieval error: {e}")
 
@@ -335,101 +491,129 @@ class Llama3MultiChatServer:
 
     def extract_memory_elements(self, chat_id, user_input, assistant_response):
         """Extract facts, preferences, and experiences from conversation"""
-        memories_added = 0
+        facts = []
+        preferences = []
+        experiences = []
+        topics = Counter()
+
+        # Facts keep the first match per pattern, skipping a position already
+        # claimed by an earlier (more specific) fact such as "i am a ..."
+        claimed = set()
+        for pattern, key in _FACT_PATTERNS:
+            for match in pattern.finditer(user_input):
+                if match.start() not in claimed:
+                    claimed.add(match.start())
+                    facts.append((chat_id, key, match.group(1).strip().lower()))
+                    break
+
+        for pattern, category in _PREF_PATTERNS:
+            for match in pattern.findall(user_input):
+                if category == "favorites":
+                    fav_type, fav_item = match
+                    facts.append((chat_id, f"favorite_{fav_type.lower()}", fav_item.lower()))
+                else:
+                    preferences.append((chat_id, category, match.lower()))
+
+        for pattern in _EXP_PATTERNS:
+            for action, object_item in pattern.findall(user_input):
+                experiences.append((chat_id, f"{action} {object_item}".lower(), user_input[:100]))
+
+        topics.update(topic.lower() for topic in _TOPIC_RE.findall(user_input))
+
+        memories_added = len(facts) + len(preferences) + len(experiences) + sum(topics.values())
+        if not memories_added:
+            return 0
 
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
-
-            fact_patterns = [
-                (r"my name is (\w+)", "name"),
-                (r"i am (\w+)", "name"),
-                (r"call me (\w+)", "name"),
-                (r"i am (\d+) years old", "age"),
-                (r"i live in ([^,.]+)", "location"),
-                (r"i work as a ([^,.]+)", "job"),
-                (r"i am a ([^,.]+)", "profession"),
-                (r"my job is ([^,.]+)", "job"),
-            ]
-
-            for pattern, key in fact_patterns:
-                match = re.search(pattern, user_input.lower())
-                if match:
-                    value = match.group(1).strip()
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO facts (chat_id, key, value, updated_at)
-                        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                    ''', (chat_id, key, value))
-                    memories_added += 1
-
-            preference_patterns = [
-                (r"i like ([^,.]+)", "likes"),
-                (r"i love ([^,.]+)", "loves"),
-                (r"i prefer ([^,.]+)", "prefers"),
-                (r"my favorite ([^\s]+) is ([^,.]+)", "favorites"),
-                (r"i don't like ([^,.]+)", "dislikes"),
-                (r"i hate ([^,.]+)", "hates"),
-            ]
-
-            for pattern, category in preference_patterns:
-                matches = re.findall(pattern, user_input.lower())
-                for match in matches:
-                    if category == "favorites":
-                        fav_type, fav_item = match
-                        fact_key = f"favorite_{fav_type}"
-                        cursor.execute('''
-                            INSERT OR REPLACE INTO facts (chat_id, key, value, updated_at)
-                            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                        ''', (chat_id, fact_key, fav_item))
-                    else:
-                        item = match if isinstance(match, str) else match[0]
-                        cursor.execute('''
-                            INSERT INTO preferences (chat_id, category, item)
-                            VALUES (?, ?, ?)
-                        ''', (chat_id, category, item))
-                    memories_added += 1
-
-            experience_patterns = [
-                r"i (went to|visited|traveled to) ([^,.]+)",
-                r"i (learned|studied) ([^,.]+)",
-                r"i (bought|purchased) ([^,.]+)",
-                r"i (finished|completed) ([^,.]+)",
-                r"i (started) ([^,.]+)",
-            ]
-
-            for pattern in experience_patterns:
-                matches = re.findall(pattern, user_input.lower())
-                for match in matches:
-                    action, object_item = match
-                    experience = f"{action} {object_item}"
-                    cursor.execute('''
-                        INSERT INTO experiences (chat_id, experience, context)
-                        VALUES (?, ?, ?)
-                    ''', (chat_id, experience, user_input[:100]))
-                    memories_added += 1
-
-            topics = re.findall(r'\b(programming|python|javascript|machine learning|ai|artificial intelligence|data science|web development|coding|software)\b', user_input.lower())
-            for topic in topics:
-                cursor.execute('''
+            # One batched statement per table
+            with self._transaction() as cursor:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO facts (chat_id, key, value, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ''', facts)
+
+                cursor.executemany('''
+                    INSERT INTO preferences (chat_id, category, item)
+                    VALUES (?, ?, ?)
+                ''', preferences)
+
+                cursor.executemany('''
+                    INSERT INTO experiences (chat_id, experience, context)
+                    VALUES (?, ?, ?)
+                ''', experiences)
+
+                cursor.executemany('''
                     INSERT INTO topics (chat_id, topic, frequency, updated_at)
-                    VALUES (?, ?, 1, CURRENT_TIMESTAMP)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
                     ON CONFLICT(chat_id, topic) DO UPDATE SET
-                        frequency = frequency + 1,
+                        frequency = frequency + excluded.frequency,
                         updated_at = CURRENT_TIMESTAMP
-                ''', (chat_id, topic))
-                memories_added += 1
-
-            conn.commit()
-            conn.close()
+                ''', [(chat_id, topic, count) for topic, count in topics.items()])
 
         except Exception as e:
             print(f"⚠️ Memory extraction error: {e}")
+            return 0
 
         return memories_added
 
     def estimate_tokens(self, text):
-        """Rough token estimation"""
-        return len(text) // 4
+        """Count tokens with the model's tokenizer"""
+        if self._tokenize is None:
+            return len(text) // 4
+        return len(self._tokenize(text.encode("utf-8"), add_bos=False, special=False))
+
+    def get_conversation_history(self, chat_id):
+        """Get the in-memory exchanges for a chat, loading them from the database on first use"""
+        history = self.chat_sessions.get(chat_id)
+        if history is not None:
+            return history
+
+        try:
+            with self._db_lock:
+                cursor = self._conn.cursor()
+
+                cursor.execute('''
+                    SELECT turn_index, role, content, tokens
+                    FROM messages
+                    WHERE chat_id = ?
+                    ORDER BY turn_index ASC, role DESC
+                ''', (chat_id,))
+
+                messages = cursor.fetchall()
+        except Exception as e:
+            print(f"⚠️ Error loading history: {e}")
+            messages = []
+
+        # Rows alternate user/assistant within a turn; a turn without a
+        # reply (e.g. an interrupted stream) is skipped
+        history = []
+        for (turn, role, content, tokens), (next_turn, next_role, next_content, next_tokens) in zip(messages, messages[1:]):
+            if role == 'user' and next_role == 'assistant' and turn == next_turn:
+                history.append({'user': content, 'assistant': next_content, 'tokens': tokens + next_tokens})
+
+        history = self.trim_history(history)
+        self.chat_sessions[chat_id] = history
+        return history
+
+    def trim_history(self, history):
+        """Bound history to the opening sink exchanges plus a recent window within the token budget"""
+        if len(history) > self.max_context_pairs:
+            # The first exchanges anchor the conversation (StreamingLLM-style
+            # sinks) and stay a stable prompt prefix for KV-cache reuse
+            recent = self.max_context_pairs - self.sink_pairs
+            history = history[:self.sink_pairs] + history[-recent:]
+
+        # Drop the oldest non-sink exchanges until the cached per-exchange
+        # token counts fit, so history is never re-tokenized for gating
+        total_tokens = sum(pair['tokens'] for pair in history)
+        drop = 0
+        while total_tokens > self.max_context_tokens and self.sink_pairs + drop < len(history) - 1:
+            total_tokens -= history[self.sink_pairs + drop]['tokens']
+            drop += 1
+
+        if drop:
+            history = history[:self.sink_pairs] + history[self.sink_pairs + drop:]
+        return history
 
     def build_context_with_memory(self, chat_id, user_input):
         """Build prompt with conversation context + episodic memory"""
@@ -439,71 +623,91 @@ class Llama3MultiChatServer:
         if relevant_memories:
             memory_context = "\n[Memory Context: " + "; ".join(relevant_memories) + "]\n"
 
-        db_messages = self.get_chat_messages(chat_id)
-
-        conversation_history = []
-        current_pair = {}
-
-        for msg in db_messages:
-            if msg['role'] == 'user':
-                if current_pair:
-                    conversation_history.append(current_pair)
-                current_pair = {'user': msg['content']}
-            elif msg['role'] == 'assistant' and 'user' in current_pair:
-                current_pair['assistant'] = msg['content']
-
-        if 'user' in current_pair and 'assistant' in current_pair:
-            conversation_history.append(current_pair)
-
-        if not conversation_history:
-            return f"<|start_header_id|>user<|end_header_id|>\n\n{memory_context}{user_input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+        # Prompt bytes go straight to the tokenizer without re-encoding history
+        return b"".join((
+            self.get_prompt_prefix(chat_id),
+            _U_PRE, (memory_context + user_input).encode("utf-8"), _U_POST,
+            _A_TRAIL,
+        ))
+
+    def get_prompt_prefix(self, chat_id):
+        """Get the encoded history prompt for a chat, rejoining the cached exchange bytes after a trim"""
+        prefix = self._prompt_prefixes.get(chat_id)
+        if prefix is None:
+            prefix = bytearray().join(map(self.encode_exchange, self.get_conversation_history(chat_id)))
+            self._prompt_prefixes[chat_id] = prefix
+        return prefix
+
+    def encode_exchange(self, exchange):
+        """Encode one user/assistant exchange in the Llama 3 chat template, once per exchange"""
+        encoded = exchange.get('encoded')
+        if encoded is None:
+            encoded = exchange['encoded'] = b"".join((
+                _U_PRE, exchange['user'].encode("utf-8"), _U_POST,
+                _A_PRE, exchange['assistant'].encode("utf-8"), _A_POST,
+            ))
+        return encoded
+
+    def add_to_conversation(self, chat_id, user_input, assistant_response, tokens=None):
+        """Add exchange to conversation with context management"""
+        if tokens is None:
+            tokens = self.estimate_tokens(user_input) + self.estimate_tokens(assistant_response)
 
-        context_parts = []
-        for exchange in conversation_history:
-            context_parts.append(f"<|start_header_id|>user<|end_header_id|>\n\n{exchange['user']}<|eot_id|>")
-            context_parts.append(f"<|start_header_id|>assistant<|end_header_id|>\n\n{exchange['assistant']}<|eot_id|>")
+        exchange = {
+            "user": user_input,
+            "assistant": assistant_response,
+            "tokens": tokens
+        }
 
-        context_parts.append(f"<|start_header_id|>user<|end_header_id|>\n\n{memory_context}{user_input}<|eot_id|>")
-        context_parts.append("<|start_header_id|>assistant<|end_header_id|>\n\n")
+        history = self.chat_sessions.setdefault(chat_id, [])
+        history.append(exchange)
+        trimmed = self.trim_history(history)
 
-        return ''.join(context_parts)
+        # Extend the cached prompt bytes in place unless the window slid; a
+        # slid window is rejoined from each exchange's cached bytes
+        prefix = self._prompt_prefixes.get(chat_id)
+        if trimmed is history and prefix is not None:
+            prefix += self.encode_exchange(exchange)
+        else:
+            self._prompt_prefixes.pop(chat_id, None)
 
-    def add_to_conversation(self, chat_id, user_input, assistant_response):
-        """Add exchange to conversation with context management"""
-        if chat_id not in self.chat_sessions:
-            self.chat_sessions[chat_id] = []
+        self.chat_sessions[chat_id] = trimmed
 
-        self.chat_sessions[chat_id].append({
-            "user": user_input,
-            "assistant": assistant_response,
-            "tokens": self.estimate_tokens(user_input + assistant_response),
-            "timestamp": datetime.now().isoformat()
-        })
+    def run_on_model(self, func, *args, on_start=None):
+        """Queue a model call on the single inference worker and wait for its result"""
+        if not self._pending_slots.acquire(blocking=False):
+            raise ModelBusyError("Model is busy, too many pending requests")
 
-        if len(self.chat_sessions[chat_id]) > self.max_context_pairs:
-            self.chat_sessions[chat_id] = self.chat_sessions[chat_id][-self.max_context_pairs:]
+        try:
+            if on_start:
+                on_start()
+            return self._model_executor.submit(func, *args).result()
+        finally:
+            self._pending_slots.release()
 
     def generate_response(self, chat_id, user_input, is_first_message=False):
         """Generate response to user input"""
         if not self.model:
-            return "Error: Model not loaded", 0
+            return "Error: Model not loaded", 0, None, None
 
-        acquired = self.model_lock.acquire(blocking=False)
-        if not acquired:
-            return "Error: Model is busy processing another request", 0
+        return self.run_on_model(self._generate_response, chat_id, user_input, is_first_message)
 
+    def _generate_response(self, chat_id, user_input, is_first_message):
+        """Run a full generation on the model worker thread"""
         try:
             if is_first_message:
                 chat_id, title = self.create_chat(user_input)
                 if not chat_id:
                     return "Error: Could not create chat", 0, None, None
+            elif not self.chat_exists(chat_id):
+                return "Error: Chat not found", 0, None, None
             else:
                 title = None
 
             prompt = self.build_context_with_memory(chat_id, user_input)
 
             result = self.model(
-                prompt,
+                self._tokenize(prompt, special=True),
                 max_tokens=512,
                 temperature=0.7,
                 top_p=0.95,
@@ -512,15 +716,21 @@ class Llama3MultiChatServer:
 
             response = result['choices'][0]['text'].strip()
 
-            self.add_to_conversation(chat_id, user_input, response)
-
             user_tokens = self.estimate_tokens(user_input)
             assistant_tokens = self.estimate_tokens(response)
 
-            self.save_message(chat_id, "user", user_input, user_tokens)
-            self.save_message(chat_id, "assistant", response, assistant_tokens)
+            self.add_to_conversation(chat_id, user_input, response, user_tokens + assistant_tokens)
+
+            # Persist the whole exchange in one transaction
+            with self._transaction():
+                self.save_message(chat_id, "user", user_input, user_tokens)
+                self.save_message(chat_id, "assistant", response, assistant_tokens)
+                memories_added = self.extract_memory_elements(chat_id, user_input, response)
 
-            memories_added = self.extract_memory_elements(chat_id, user_input, response)
+            # Generate the real title after the reply, queued behind it on the
+            # model worker, so the first response isn't delayed by it
+            if is_first_message:
+                self._model_executor.submit(self.update_chat_title, chat_id, user_input)
 
             return response, memories_added, chat_id, title
 
@@ -528,19 +738,25 @@ class Llama3MultiChatServer:
             print(f"❌ Generation error: {e}")
             return f"Sorry, error occurred: {str(e)}", 0, None, None
 
-        finally:
-            self.model_lock.release()
+    def generate_streaming_response(self, chat_id, user_input, send_event, on_start=None):
+        """Generate streaming response to user input
 
-    def generate_streaming_response(self, chat_id, user_input, output_stream):
-        """Generate streaming response to user input"""
+        send_event writes and flushes one SSE event payload. on_start is
+        called once the request has been admitted to the model queue,
+        before any output is written.
+        """
         if not self.model:
             return "Error: Model not loaded", 0
 
-        acquired = self.model_lock.acquire(blocking=False)
-        if not acquired:
-            return "Error: Model is busy processing another request", 0
+        return self.run_on_model(self._generate_streaming_response, chat_id, user_input, send_event, on_start=on_start)
 
+    def _generate_streaming_response(self, chat_id, user_input, send_event):
+        """Run a streaming generation on the model worker thread"""
         try:
+            if not self.chat_exists(chat_id):
+                self.write_error_frame(send_event, "Chat not found")
+                return "Error: Chat not found", 0
+
             # Save user message immediately
             user_tokens = self.estimate_tokens(user_input)
             self.save_message(chat_id, "user", user_input, user_tokens)
@@ -548,7 +764,7 @@ class Llama3MultiChatServer:
             prompt = self.build_context_with_memory(chat_id, user_input)
 
             stream_response = self.model(
-                prompt,
+                self._tokenize(prompt, special=True),
                 max_tokens=512,
                 temperature=0.7,
                 top_p=0.95,
@@ -557,9 +773,11 @@ class Llama3MultiChatServer:
             )
 
             response_parts = []
+            sent_count = 0
             client_connected = True
+            last_flush = time.monotonic()
 
-            # Continue generation regardless of client connection
+            # Stop generating once the client has gone away; the partial reply is kept
             for chunk in stream_response:
                 if isinstance(chunk, dict):
                     token = None
@@ -579,24 +797,30 @@ class Llama3MultiChatServer:
                     if token:
                         response_parts.append(token)
 
-                        # Try to send to client, but don't stop generation if disconnected
-                        if client_connected:
-                            token_data = {'token': token}
-                            try:
-                                output_stream.write(f"data: {json.dumps(token_data)}\n\n".encode())
-                                output_stream.flush()
-                            except (BrokenPipeError, ConnectionResetError):
-                                print("Client disconnected - continuing generation in background")
-                                client_connected = False
+                        # Batch tokens into one SSE frame every few tokens or milliseconds
+                        if (
+                            len(response_parts) - sent_count >= self.stream_batch_tokens
+                            or time.monotonic() - last_flush >= self.stream_batch_interval
+                        ):
+                            client_connected = self.write_token_frame(send_event, response_parts[sent_count:])
+                            if not client_connected:
+                                break
+                            sent_count = len(response_parts)
+                            last_flush = time.monotonic()
+
+            if client_connected and sent_count < len(response_parts):
+                self.write_token_frame(send_event, response_parts[sent_count:])
 
             # Complete response generated, save to database
             response = ''.join(response_parts)
 
             if response:
-                self.add_to_conversation(chat_id, user_input, response)
-                assistant_tokens = self.estimate_tokens(response)
-                self.save_message(chat_id, "assistant", response, assistant_tokens)
-                memories_added = self.extract_memory_elements(chat_id, user_input, response)
+                # Each streamed chunk is one generated token
+                assistant_tokens = len(response_parts)
+                self.add_to_conversation(chat_id, user_input, response, user_tokens + assistant_tokens)
+                with self._transaction():
+                    self.save_message(chat_id, "assistant", response, assistant_tokens)
+                    memories_added = self.extract_memory_elements(chat_id, user_input, response)
             else:
                 memories_added = 0
 
@@ -604,42 +828,70 @@ class Llama3MultiChatServer:
 
         except Exception as e:
             print(f"❌ Streaming generation error: {e}")
+            self.write_error_frame(send_event, f"Sorry, error occurred: {str(e)}")
             return f"Sorry, error occurred: {str(e)}", 0
 
-        finally:
-            self.model_lock.release()
+    def write_token_frame(self, send_event, tokens):
+        """Send a batch of tokens as one SSE event, returning False if the client went away"""
+        try:
+            send_event(b'{"token": ' + orjson.dumps(''.join(tokens)) + b'}')
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            print("Client disconnected - stopping generation")
+            return False
+
+    def write_error_frame(self, send_event, message):
+        """Send an error as one SSE event so the client can replace its placeholder"""
+        try:
+            send_event(orjson.dumps({'error': message}))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
     def delete_chat(self, chat_id):
         """Delete a chat and all its data"""
         try:
-            conn = sqlite3.connect(self.memory_db)
-            cursor = conn.cursor()
+            with self._transaction() as cursor:
+                cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
 
-            cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-            conn.commit()
-            conn.close()
+            # Child rows are removed by ON DELETE CASCADE; hand the freed pages back
+            # (executescript steps the pragma to completion, execute() frees one page)
+            with self._db_lock:
+                self._conn.executescript("PRAGMA incremental_vacuum;")
 
-            if chat_id in self.chat_sessions:
-                del self.chat_sessions[chat_id]
+            # Session caches are only touched on the model worker; evicting there
+            # runs after any generation for this chat that is already queued
+            self._model_executor.submit(self.forget_chat, chat_id)
 
             return True
         except Exception as e:
             print(f"⚠️ Error deleting chat: {e}")
             return False
 
+    def forget_chat(self, chat_id):
+        """Drop a deleted chat's in-memory session state (runs on the model worker)"""
+        self.chat_sessions.pop(chat_id, None)
+        self._turn_counters.pop(chat_id, None)
+        self._prompt_prefixes.pop(chat_id, None)
+
     def shutdown(self):
         """Graceful shutdown of chat server"""
         print("🔄 Chat server shutting down...")
 
         # Wait for any ongoing model operations
-        if hasattr(self, 'model_lock') and self.model_lock:
+        if hasattr(self, '_model_executor') and self._model_executor:
             print("⏳ Waiting for model operations to complete...")
-            with self.model_lock:
-                print("✅ Model operations completed")
+            self._model_executor.shutdown(wait=True)
+            print("✅ Model operations completed")
 
         # Clear in-memory sessions
         self.chat_sessions.clear()
 
+        # Close the shared database connection
+        if hasattr(self, '_conn') and self._conn:
+            with self._db_lock:
+                self._conn.close()
+                self._conn = None
+
         # Model cleanup (if needed)
         if hasattr(self, 'model') and self.model:
             print("🧹 Cleaning up model resources...")
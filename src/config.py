@@ -13,5 +13,18 @@ LLAMA3_MODEL = {
     "name": "Llama 3 8B Q4_K_M",
     "description": "Llama 3 8B Instruct, 4-bit quantized",
     "n_ctx": 8192,
-    "n_gpu_layers": -1
+    "n_gpu_layers": -1,
+    # Prefill batch size and CPU threads (generation on physical cores,
+    # batched prompt evaluation on all logical cores)
+    "n_batch": 512,
+    "n_threads": max((os.cpu_count() or 2) // 2, 1),
+    "n_threads_batch": os.cpu_count() or 1,
+    # Only the last position's logits are needed for sampling
+    "logits_all": False,
+    "use_mmap": True,
+    "use_mlock": False,
+    # RAM budget for saved KV-cache states, keyed by prompt prefix (0 disables).
+    # Off by default: every completion then ends with a synchronous state
+    # snapshot on the model worker, so only enable it where it was measured to help
+    "kv_cache_bytes": 0
 }
\ No newline at end of file
@@ -1,65 +1,172 @@
 """HTTP request handler for ChatLlama server."""
 
-import json
+import hashlib
+import queue
+import re
+import socket
+import threading
+import zlib
+from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler
+from pathlib import Path
+
+import orjson
+
+from chat_server import ModelBusyError
+
+
+# Chat IDs are UUIDs; anything else in an ID path segment is rejected
+_CHAT_ID_RE = re.compile(r'[0-9A-Za-z_-]+')
+
+_STATIC_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+}
+
+
+def load_static_files(directory):
+    """Read the frontend assets into memory as {path: (body, etag, content_type)}"""
+    static_files = {}
+    for path in Path(directory).iterdir():
+        content_type = _STATIC_TYPES.get(path.suffix)
+        if content_type and path.is_file():
+            body = path.read_bytes()
+            etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+            static_files[f'/{path.name}'] = (body, etag, content_type)
+    return static_files
+
+
+_CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Content-Type'),
+)
+
+
+def accepts_gzip(accept_encoding):
+    """Check an Accept-Encoding header for gzip with a non-zero q-value"""
+    gzip_q = any_q = None
+    for entry in accept_encoding.split(','):
+        coding, _, params = entry.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding in ('gzip', 'x-gzip'):
+            gzip_q = q
+        elif coding == '*':
+            any_q = q
+
+    # An explicit gzip entry wins over the wildcard
+    if gzip_q is None:
+        gzip_q = any_q or 0.0
+    return gzip_q > 0
+
+
+def build_header_block(protocol_version, status, headers):
+    """Pre-render a status line and fixed headers, leaving the block open for per-response headers"""
+    status = HTTPStatus(status)
+    lines = [f"{protocol_version} {status.value} {status.phrase}\r\n"]
+    lines.extend(f"{name}: {value}\r\n" for name, value in headers)
+    return "".join(lines).encode('latin-1')
 
 
 class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
-    def __init__(self, *args, chat_server=None, **kwargs):
-        self.chat_server = chat_server
-        super().__init__(*args, **kwargs)
-
-    def end_headers(self):
-        """Add cache-busting headers for CSS and JS files"""
-        if self.path.endswith(('.css', '.js')):
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-        super().end_headers()
+    # Process-wide Llama3MultiChatServer, assigned once at startup
+    chat_server = None
+
+    # SSE events buffered per client, and how long generation may wait on a stalled one
+    sse_queue_size = 64
+    sse_stall_timeout = 30
+    # Frontend assets are served from memory; restart the server to pick up edits
+    static_files = load_static_files(Path(__file__).parent)
+
+    # Responses are written as whole frames/blocks, so keep wfile unbuffered:
+    # every write()/flush() is exactly one send()
+    wbufsize = 0
+
+    # Only API requests are logged
+    _LOG_PATHS = ('/chat', '/new-chat', '/chats')
+
+    # Pre-encoded SSE framing
+    _SSE_DATA = b"data: "
+    _SSE_END = b"\n\n"
+    _SSE_DONE = b"data: [DONE]\n\n"
+    # The closing stats event has a fixed shape, so it skips JSON encoding
+    _SSE_FINAL = b'data: {"memories_added":%d,"memory_stats":{"facts":%d,"experiences":%d,"topics":%d}}\n\n'
+
+    # Header blocks for JSON and preflight responses, which never vary
+    _JSON_HEADERS = {
+        status: build_header_block(SimpleHTTPRequestHandler.protocol_version, status, (('Content-type', 'application/json'), *_CORS_HEADERS))
+        for status in (200, 400, 500, 503)
+    }
+    _OPTIONS_HEADERS = build_header_block(SimpleHTTPRequestHandler.protocol_version, 200, _CORS_HEADERS)
+
+    def setup(self):
+        """Disable Nagle's algorithm so small SSE frames and responses go out immediately"""
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def do_GET(self):
         """Handle GET requests"""
         if self.path == '/':
             self.path = '/index.html'
-        elif self.path == '/chats':
-            self.handle_get_chats()
+        elif self.dispatch(self._GET_EXACT, self._GET_PREFIX):
             return
-        elif self.path.startswith('/chat/'):
-            chat_id = self.path.split('/')[-1]
-            self.handle_get_chat_messages(chat_id)
-            return
-        elif self.path.startswith('/memory-stats/'):
-            chat_id = self.path.split('/')[-1]
-            self.handle_memory_stats(chat_id)
+
+        static = self.static_files.get(self.path)
+        if static is not None:
+            self.send_static_file(*static)
             return
 
         return super().do_GET()
 
     def do_POST(self):
         """Handle POST requests"""
-        if self.path == '/chat':
-            self.handle_chat()
-        elif self.path == '/chat-stream':
-            self.handle_chat_stream()
-        elif self.path == '/new-chat':
-            self.handle_new_chat()
-        else:
+        if not self.dispatch(self._POST_EXACT):
             self.send_error(404)
 
     def do_DELETE(self):
         """Handle DELETE requests"""
-        if self.path.startswith('/chat/'):
-            chat_id = self.path.split('/')[-1]
-            self.handle_delete_chat(chat_id)
-        else:
+        if not self.dispatch(prefix_routes=self._DELETE_PREFIX):
             self.send_error(404)
 
+    def dispatch(self, exact_routes=None, prefix_routes=()):
+        """Route the request path through the method's tables, returning False if nothing matched"""
+        path = self.path
+        route = exact_routes.get(path) if exact_routes else None
+        if route is not None:
+            route(self)
+            return True
+        for prefix, route in prefix_routes:
+            if path.startswith(prefix):
+                chat_id = path[len(prefix):]
+                if _CHAT_ID_RE.fullmatch(chat_id):
+                    route(self, chat_id)
+                else:
+                    self.send_json_response({'error': 'Invalid chat_id'}, 400)
+                return True
+        return False
+
+    def read_json_body(self):
+        """Read and parse the JSON request body"""
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        body = bytearray(length)
+        self.rfile.readinto(body)
+        return orjson.loads(body)
+
     def handle_new_chat(self):
         """Handle new chat creation"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
 
             message = data.get('message', '').strip()
             if not message:
@@ -74,22 +181,18 @@ class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
                 self.send_json_response({'error': 'Failed to create chat'}, 500)
                 return
 
-            facts_count, experiences_count, topics_count = self.chat_server.get_memory_counts(chat_id)
-
             self.send_json_response({
                 'chat_id': chat_id,
                 'title': title,
                 'response': response,
                 'memories_added': memories_added,
-                'memory_stats': {
-                    'facts': facts_count,
-                    'experiences': experiences_count,
-                    'topics': topics_count
-                }
+                'memory_stats': self.chat_server.get_memory_stats_payload(chat_id)
             })
 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             self.send_json_response({'error': 'Invalid JSON'}, 400)
+        except ModelBusyError as e:
+            self.send_json_response({'error': str(e)}, 503)
         except Exception as e:
             print(f"New chat error: {e}")
             self.send_json_response({'error': str(e)}, 500)
@@ -97,9 +200,7 @@ class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
     def handle_chat(self):
         """Handle chat messages"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
 
             message = data.get('message', '').strip()
             chat_id = data.get('chat_id')
@@ -114,20 +215,16 @@ class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
 
             response, memories_added, _, _ = self.chat_server.generate_response(chat_id, message)
 
-            facts_count, experiences_count, topics_count = self.chat_server.get_memory_counts(chat_id)
-
             self.send_json_response({
                 'response': response,
                 'memories_added': memories_added,
-                'memory_stats': {
-                    'facts': facts_count,
-                    'experiences': experiences_count,
-                    'topics': topics_count
-                }
+                'memory_stats': self.chat_server.get_memory_stats_payload(chat_id)
             })
 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             self.send_json_response({'error': 'Invalid JSON'}, 400)
+        except ModelBusyError as e:
+            self.send_json_response({'error': str(e)}, 503)
         except Exception as e:
             print(f"Chat error: {e}")
             self.send_json_response({'error': str(e)}, 500)
@@ -135,9 +232,7 @@ class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
     def handle_chat_stream(self):
         """Handle streaming chat messages"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
 
             message = data.get('message', '').strip()
             chat_id = data.get('chat_id')
@@ -152,47 +247,140 @@ class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
 
             self.send_streaming_response(chat_id, message)
 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             self.send_json_response({'error': 'Invalid JSON'}, 400)
         except Exception as e:
             print(f"Streaming chat error: {e}")
             self.send_json_response({'error': str(e)}, 500)
 
+    def start_event_stream(self):
+        """Send the SSE response headers"""
+        # Gzip the stream when the client accepts it; each frame is sync-flushed
+        # so tokens still arrive immediately
+        self.sse_compressor = None
+        if accepts_gzip(self.headers.get('Accept-Encoding', '')):
+            self.sse_compressor = zlib.compressobj(wbits=31)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'keep-alive')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if self.sse_compressor:
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+
+    def write_frame(self, frame):
+        """Write one complete SSE frame and flush it to the client"""
+        if self.sse_compressor:
+            frame = self.sse_compressor.compress(frame) + self.sse_compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(frame)
+        self.wfile.flush()
+
+    def end_frames(self):
+        """Terminate the compressed stream, if any"""
+        if self.sse_compressor:
+            self.wfile.write(self.sse_compressor.flush())
+            self.wfile.flush()
+
     def send_streaming_response(self, chat_id, message):
         """Send streaming SSE response"""
+        # Events pass through a bounded queue to a writer thread, so a slow
+        # client holds at most sse_queue_size frames and never blocks the model
+        # for longer than sse_stall_timeout
+        events = queue.Queue(maxsize=self.sse_queue_size)
+        abort = threading.Event()
+        writer = threading.Thread(target=self.drain_events, args=(events, abort), name="sse-writer", daemon=True)
+        backpressure = 0
+
+        def send_frame(frame):
+            nonlocal backpressure
+            if abort.is_set():
+                raise BrokenPipeError("Client disconnected")
+            try:
+                events.put_nowait(frame)
+            except queue.Full:
+                backpressure += 1
+                try:
+                    events.put(frame, timeout=self.sse_stall_timeout)
+                except queue.Full:
+                    abort.set()
+                    # Unblock a writer stuck in a send to the stalled client
+                    try:
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    raise BrokenPipeError("Client stalled")
+
+        def send_event(payload):
+            send_frame(b"".join((self._SSE_DATA, payload, self._SSE_END)))
+
+        def on_start():
+            self.start_event_stream()
+            writer.start()
+
         try:
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/event-stream')
-            self.send_header('Cache-Control', 'no-cache')
-            self.send_header('Connection', 'keep-alive')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+            # Headers go out only once the request is admitted to the model
+            # queue, so a full queue can still be answered with a 503
+            try:
+                response, memories_added = self.chat_server.generate_streaming_response(
+                    chat_id, message, send_event, on_start=on_start
+                )
+            except ModelBusyError as e:
+                self.send_json_response({'error': str(e)}, 503)
+                return
 
-            response, memories_added = self.chat_server.generate_streaming_response(chat_id, message, self.wfile)
+            if writer.ident is None:
+                # Generation never started (e.g. no model), so no stream is open
+                self.send_json_response({'error': response}, 500)
+                return
 
-            facts_count, experiences_count, topics_count = self.chat_server.get_memory_counts(chat_id)
-            final_data = {
-                'memories_added': memories_added,
-                'memory_stats': {
-                    'facts': facts_count,
-                    'experiences': experiences_count,
-                    'topics': topics_count
-                }
-            }
+            memory_stats = self.chat_server.get_memory_stats_payload(chat_id)
 
             try:
-                self.wfile.write(f"data: {json.dumps(final_data)}\n\n".encode())
-                self.wfile.write(b"data: [DONE]\n\n")
-                self.wfile.flush()
-            except (BrokenPipeError, ConnectionResetError):
+                send_frame(self._SSE_FINAL % (
+                    memories_added, memory_stats['facts'], memory_stats['experiences'], memory_stats['topics']
+                ))
+                send_frame(self._SSE_DONE)
+            except BrokenPipeError:
                 print("Client disconnected before final response")
 
         except Exception as e:
             print(f"Streaming error: {e}")
             error_data = {'error': str(e)}
+            if writer.ident is None:
+                self.send_json_response(error_data, 500)
+                return
+            try:
+                send_event(orjson.dumps(error_data))
+            except BrokenPipeError:
+                pass
+
+        finally:
+            if writer.ident is not None:
+                try:
+                    if abort.is_set():
+                        events.put_nowait(None)
+                    else:
+                        events.put(None, timeout=self.sse_stall_timeout)
+                except queue.Full:
+                    abort.set()
+                writer.join(self.sse_stall_timeout)
+            if backpressure:
+                print(f"⚠️ SSE backpressure: event queue full {backpressure} times for chat {chat_id}")
+
+    def drain_events(self, events, abort):
+        """Write queued SSE frames until the end-of-stream marker"""
+        while not abort.is_set() and (frame := events.get()) is not None:
             try:
-                self.wfile.write(f"data: {json.dumps(error_data)}\n\n".encode())
-                self.wfile.flush()
+                self.write_frame(frame)
+            except (BrokenPipeError, ConnectionResetError):
+                abort.set()
+
+        if not abort.is_set():
+            try:
+                self.end_frames()
             except (BrokenPipeError, ConnectionResetError):
                 pass
 
@@ -217,14 +405,8 @@ class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
     def handle_memory_stats(self, chat_id):
         """Handle memory stats requests for a specific chat"""
         try:
-            facts_count, experiences_count, topics_count = self.chat_server.get_memory_counts(chat_id)
-
             self.send_json_response({
-                'memory_stats': {
-                    'facts': facts_count,
-                    'experiences': experiences_count,
-                    'topics': topics_count
-                }
+                'memory_stats': self.chat_server.get_memory_stats_payload(chat_id)
             })
         except Exception as e:
             print(f"Memory stats error: {e}")
@@ -244,26 +426,56 @@ class MultiChatHTTPRequestHandler(SimpleHTTPRequestHandler):
 
     def send_json_response(self, data, status=200):
         """Send JSON response"""
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+        response_data = orjson.dumps(data)
+        headers = self._JSON_HEADERS.get(status)
+        if headers is None:
+            headers = build_header_block(self.protocol_version, status, (('Content-type', 'application/json'), *_CORS_HEADERS))
+
+        # Headers and body go out in a single write
+        self.log_request(status)
+        self.wfile.write(b"".join((
+            headers,
+            b"Date: ", self.date_time_string().encode('latin-1'),
+            b"\r\nContent-Length: ", str(len(response_data)).encode('latin-1'),
+            b"\r\n\r\n", response_data,
+        )))
+
+    def send_static_file(self, body, etag, content_type):
+        """Send a cached asset, or 304 if the client already has this version"""
+        # Browsers revalidate every load, which costs only a 304 while unchanged
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'public, max-age=0, must-revalidate')
+            self.end_headers()
+            return
 
-        response_data = json.dumps(data, ensure_ascii=False).encode('utf-8')
-        self.wfile.write(response_data)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=0, must-revalidate')
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+        self.log_request(200)
+        self.wfile.write(b"".join((
+            self._OPTIONS_HEADERS,
+            b"Date: ", self.date_time_string().encode('latin-1'),
+            b"\r\nContent-Length: 0\r\n\r\n",
+        )))
 
     def log_message(self, format, *args):
         """Override to reduce verbose logging"""
-        if not any(path in self.path for path in ['/chat', '/new-chat', '/chats']):
+        # path is unset when the request line itself could not be parsed
+        if not getattr(self, 'path', '').startswith(self._LOG_PATHS):
             return
-        super().log_message(format, *args)
\ No newline at end of file
+        super().log_message(format, *args)
+
+    # Route tables, built once; prefix routes receive the rest of the path as the chat ID
+    _GET_EXACT = {'/chats': handle_get_chats}
+    _GET_PREFIX = (('/chat/', handle_get_chat_messages), ('/memory-stats/', handle_memory_stats))
+    _POST_EXACT = {'/chat': handle_chat, '/chat-stream': handle_chat_stream, '/new-chat': handle_new_chat}
+    _DELETE_PREFIX = (('/chat/', handle_delete_chat),)
@@ -1,6 +1,7 @@
 """Main entry point for ChatLlama server."""
 
 import os
+import platform
 import sys
 import signal
 import threading
@@ -11,11 +12,21 @@ from chat_server import Llama3MultiChatServer
 from http_handler import MultiChatHTTPRequestHandler
 
 
+class ChatHTTPServer(ThreadingHTTPServer):
+    """Thread-per-connection HTTP server that does not wait on open streams at close"""
+    # Idle keep-alive and SSE connections would otherwise block server_close()
+    block_on_close = False
+
+
 def main():
     """Main server function"""
     print("🚀 Llama 3 8B Multi-Chat HTTP Server")
     print("=" * 40)
 
+    # Free-threaded (3.13t) builds run handler threads alongside inference
+    gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"🧵 Python {platform.python_version()} ({'GIL enabled' if gil_enabled else 'free-threaded'})")
+
     # Check if model exists
     model_path = LLAMA3_MODEL["path"]
     if not os.path.exists(model_path):
@@ -35,10 +46,8 @@ def main():
     port = int(os.environ.get('PORT', 8000))
     server_address = ('', port)
 
-    def handler(*args, **kwargs):
-        MultiChatHTTPRequestHandler(*args, chat_server=chat_server, **kwargs)
-
-    httpd = ThreadingHTTPServer(server_address, handler)
+    MultiChatHTTPRequestHandler.chat_server = chat_server
+    httpd = ChatHTTPServer(server_address, MultiChatHTTPRequestHandler)
 
     # Set up graceful shutdown
     shutdown_event = threading.Event()
@@ -50,29 +59,36 @@ def main():
         # Signal shutdown to all components
         shutdown_event.set()
 
-        # Shutdown HTTP server
-        print("🛑 Stopping HTTP server...")
-        httpd.shutdown()
-        httpd.server_close()
-
-        # Gracefully shutdown chat server
-        chat_server.shutdown()
-
-        print("✅ Server stopped gracefully")
-        sys.exit(0)
-
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGTERM, signal_handler)  # Docker stop
     signal.signal(signal.SIGINT, signal_handler)   # Ctrl+C
 
+    # Serve from a worker thread: httpd.shutdown() blocks until serve_forever()
+    # returns, so it deadlocks if called from a signal handler on the serving thread
+    server_thread = threading.Thread(target=httpd.serve_forever, name="http-server", daemon=True)
+    server_thread.start()
+
     print(f"🌐 Server running at http://localhost:{port}")
     print("=" * 40)
 
     try:
-        httpd.serve_forever()
+        # Wake periodically: a set() from a signal handler that interrupts
+        # this same thread's wait() can otherwise go unnoticed
+        while not shutdown_event.wait(1):
+            pass
     except KeyboardInterrupt:
         # This shouldn't be reached due to signal handler, but just in case
-        signal_handler(signal.SIGINT, None)
+        shutdown_event.set()
+
+    # Shutdown HTTP server
+    print("🛑 Stopping HTTP server...")
+    httpd.shutdown()
+    httpd.server_close()
+
+    # Gracefully shutdown chat server
+    chat_server.shutdown()
+
+    print("✅ Server stopped gracefully")
 
 
 if __name__ == "__main__":
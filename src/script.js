@@ -47,6 +47,31 @@
             }
         }
 
+        async function waitForGeneratedTitle(chatId, placeholderTitle, attempts = 30, interval = 2000) {
+            // Title generation queues behind other model work, so poll with a bound
+            for (let i = 0; i < attempts; i++) {
+                await new Promise(resolve => setTimeout(resolve, interval));
+
+                try {
+                    const response = await fetch('/chats');
+                    const data = await response.json();
+                    const chat = (data.chats || []).find(c => c.id === chatId);
+                    if (!chat) return; // Chat was deleted
+
+                    if (chat.title !== placeholderTitle) {
+                        chats = data.chats;
+                        renderChatList();
+                        if (chatId === currentChatId) {
+                            chatTitle.textContent = chat.title;
+                        }
+                        return;
+                    }
+                } catch (error) {
+                    console.error('Failed to check chat title:', error);
+                }
+            }
+        }
+
         function renderChatList() {
             chatList.innerHTML = '';
 
@@ -204,6 +229,9 @@
                     addMessageToUI('assistant', data.response, data.memories_added || 0);
 
                     updateMemoryDisplay(data.memory_stats);
+
+                    // The generated title replaces the placeholder once the model gets to it
+                    waitForGeneratedTitle(data.chat_id, data.title);
                 }
             } catch (error) {
                 addErrorMessage('Failed to create new chat: ' + error.message);
@@ -299,6 +327,10 @@
                                     finalizeStreamingMessage(assistantMessageId, parsed.memories_added);
                                     updateMemoryDisplay(parsed.memory_stats);
                                     scrollToBottom();
+                                } else if (parsed.error) {
+                                    console.error('Streaming error:', parsed.error); // Debug
+                                    removeMessage(assistantMessageId);
+                                    addErrorMessage(parsed.error);
                                 }
                             } catch (e) {
                                 console.error('Failed to parse streaming data:', e, 'Data was:', data);
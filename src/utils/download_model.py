@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 """Download Llama 3 8B GGUF model from Hugging Face"""
 
+import os
 from pathlib import Path
+
+# huggingface_hub fetches Xet-backed files through hf_xet (one of its own
+# dependencies); let it use all available cores and bandwidth. Must be set
+# before hf_xet is loaded
+os.environ.setdefault("HF_XET_HIGH_PERFORMANCE", "1")
+
 from huggingface_hub import hf_hub_download
 
 def main():